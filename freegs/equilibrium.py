@@ -3,7 +3,7 @@ Defines class to represent the equilibrium
 state, including plasma and coil currents
 """
 
-from numpy import meshgrid, linspace, exp, zeros, nditer
+from numpy import meshgrid, linspace, exp, zeros, nditer, multiply, copyto, eye, einsum, float64, ascontiguousarray
 from scipy import interpolate
 from scipy.integrate import romb, quad # Romberg integration
 
@@ -17,6 +17,29 @@ from . import multigrid
 
 from . import machine
 
+from functools import lru_cache
+import inspect
+
+@lru_cache(maxsize=32)
+def _createVcycle(nx, ny, Rmin, Rmax, Zmin, Zmax, nlevels, ncycle, niter, direct):
+    """
+    Create a multigrid solver, caching on all inputs.
+
+    The solver is deterministic in these arguments, and building it
+    involves sparse matrix assembly and an LU factorisation at the
+    coarsest level, so equilibria sharing a grid and geometry (parameter
+    scans, refinement loops) reuse the same solver object. The solvers
+    keep only per-call scratch state, so sharing is safe for the usual
+    sequential use
+    """
+    generator = GSsparse(Rmin, Rmax, Zmin, Zmax)
+    return multigrid.createVcycle(nx, ny,
+                                  generator,
+                                  nlevels=nlevels,
+                                  ncycle=ncycle,
+                                  niter=niter,
+                                  direct=direct)
+
 class Equilibrium:
     """
     Represents the equilibrium state, including
@@ -46,88 +69,155 @@ class Equilibrium:
                  Rmin=0.1, Rmax=2.0,
                  Zmin=-1.0, Zmax=1.0,
                  nx=65, ny=65,
-                 boundary=freeBoundary):
+                 boundary=freeBoundary,
+                 dtype=float64,
+                 pgreen=None,
+                 psi=None):
         """
         Initialises a plasma equilibrium
-        
+
         Rmin, Rmax  - Range of major radius R [m]
         Zmin, Zmax  - Range of height Z [m]
-        
+
         nx - Resolution in R. This must be 2^n + 1
         ny - Resolution in Z. This must be 2^m + 1
-        
+
         boundary - The boundary condition, either freeBoundary or fixedBoundary
-        
+
+        dtype - Data type for psi and the (R,Z) grids. float32 halves
+                the memory bandwidth of the elliptic solve; spline fits
+                and integrals are still done in double precision
+
+        pgreen - Optional precomputed coil Greens functions on this grid,
+                 as returned by tokamak.createPsiGreens. Used by refine
+                 and coarsen to avoid re-evaluating the elliptic integrals
+
+        psi - Optional initial guess for the plasma psi [nx, ny].
+              If not given, a Gaussian starting guess is calculated
+
         """
 
         self.tokamak = tokamak
 
         self._applyBoundary = boundary
-        
+
+        self.dtype = dtype
+
         self.Rmin = Rmin
         self.Rmax = Rmax
         self.Zmin = Zmin
         self.Zmax = Zmax
-        
-        dR = (Rmax - Rmin)/(nx - 1)
-        dZ = (Zmax - Zmin)/(ny - 1)
-        
-        yymid = 1 - Zmax/(Zmax - Zmin)
-        
-        # Starting guess for psi
-        xx, yy = meshgrid(linspace(0,1,nx), linspace(0,1,ny), indexing='ij')
-        psi = exp( - ( (xx - 0.5)**2 + (yy - yymid)**2 ) / 0.4**2 )
-        
-        psi[0,:] = 0.0
-        psi[:,0] = 0.0
-        psi[-1,:] = 0.0
-        psi[:,-1] = 0.0
-        
-        self.R = zeros([nx,ny])
-        for x in range(nx):
-            self.R[x,:] = Rmin + x * dR
-            
-        self.Z = zeros([nx,ny])
-        for y in range(ny):
-            self.Z[:,y] = Zmin + y*dZ
-            
+
+        if psi is None:
+            # Starting guess for psi
+            yymid = 1 - Zmax/(Zmax - Zmin)
+
+            xx, yy = meshgrid(linspace(0,1,nx, dtype=dtype),
+                              linspace(0,1,ny, dtype=dtype), indexing='ij')
+            psi = exp( - ( (xx - 0.5)**2 + (yy - yymid)**2 ) / 0.4**2 )
+
+            # Zero the value on all boundaries with a single mask multiply
+            bndry_mask = zeros([nx,ny], dtype=dtype)
+            bndry_mask[1:-1,1:-1] = 1.0
+            psi *= bndry_mask
+
+        self.R, self.Z = meshgrid(linspace(Rmin, Rmax, nx, dtype=dtype),
+                                  linspace(Zmin, Zmax, ny, dtype=dtype),
+                                  indexing='ij')
+
+        # 1D (contiguous) grid point locations, used for spline fitting.
+        # Slices of R and Z are strided views, which force copies inside
+        # FITPACK routines
+        self._R1d = ascontiguousarray(self.R[:,0])
+        self._Z1d = ascontiguousarray(self.Z[0,:])
+
+        # Buffer for the G-S right-hand side, re-used by solve(),
+        # and a mask marking the boundary ring
+        self._rhs = zeros([nx,ny], dtype=dtype)
+        self._jtor_buf = zeros([nx,ny], dtype=dtype)
+        self._bmask = zeros([nx,ny], dtype=bool)
+        self._bmask[0,:] = self._bmask[-1,:] = True
+        self._bmask[:,0] = self._bmask[:,-1] = True
+
+        # Romberg integration weights in R and Z, so that 2D integrals
+        # reduce to a single tensor contraction in solve().
+        # romb is linear, so applying it to the identity gives the
+        # weight applied to each sample.
+        self._romb_wR = romb(eye(nx), axis=0)
+        self._romb_wZ = romb(eye(ny), axis=0)
+
         self._updatePlasmaPsi(psi)
         
         # Calculate coil Greens functions. This is an optimisation,
         # used in self.psi() to speed up calculations
-        self._pgreen = tokamak.createPsiGreens(self.R, self.Z)
+        if pgreen is None:
+            pgreen = tokamak.createPsiGreens(self.R, self.Z)
+        self._pgreen = pgreen
+
+        # Stack the Greens functions into one (ncoils, nx, ny) array,
+        # so summing over coils becomes a single contraction with the
+        # currents vector. None if the machine has no coils
+        self._pgreen_stack = tokamak.stackPsiGreens(pgreen)
+
+        # Cache for the coil contribution to psi, keyed on coil currents.
+        # Avoids re-summing the Greens functions when currents are unchanged
+        self._psi_coil_cache = None
+        self._psi_coil_key = None
 
         self._current = 0.0 # Plasma current
 
         # Create the solver
-        generator = GSsparse(Rmin, Rmax, Zmin, Zmax)
-        self._solver = multigrid.createVcycle(nx, ny,
-                                              generator,
-                                              nlevels=1,
-                                              ncycle=1,
-                                              niter=2,
-                                              direct=True)
-        
-    def setSolverVcycle(nlevels=1, ncycle=1, niter=1, direct=True):
+        self._solver = _createVcycle(nx, ny,
+                                     Rmin, Rmax, Zmin, Zmax,
+                                     nlevels=1,
+                                     ncycle=1,
+                                     niter=2,
+                                     direct=True)
+
+    def setSolverVcycle(self, nlevels=1, ncycle=1, niter=1, direct=True):
         """
         Creates a new linear solver, based on the multigrid code
-    
+
         nlevels  - Number of resolution levels, including original
         ncycle   - The number of V cycles
         niter    - Number of linear solver (Jacobi) iterations per level
         direct   - Use a direct solver at the coarsest level?
-        
+
         """
-        generator = GSsparse(Rmin, Rmax, Zmin, Zmax)
         nx,ny = self.R.shape
-        
-        self._solver = multigrid.createVcycle(nx, ny,
-                                              generator,
-                                              nlevels=nlevels,
-                                              ncycle=ncycle,
-                                              niter=niter,
-                                              direct=direct)
-        
+
+        self._solver = _createVcycle(nx, ny,
+                                     self.Rmin, self.Rmax,
+                                     self.Zmin, self.Zmax,
+                                     nlevels=nlevels,
+                                     ncycle=ncycle,
+                                     niter=niter,
+                                     direct=direct)
+
+    def setSolverCUDA(self, nlevels=4, ncycle=1, niter=4, direct=True):
+        """
+        Creates a new linear solver running on the GPU through CuPy.
+        Worthwhile on large (refined) grids, where the memory-bound
+        Jacobi smoothing runs at device memory bandwidth.
+
+        Raises ImportError if CuPy is not available.
+
+        nlevels  - Number of resolution levels, including original
+        ncycle   - The number of V cycles
+        niter    - Number of linear solver (Jacobi) iterations per level
+        direct   - Use a direct solver at the coarsest level?
+
+        """
+        generator = GSsparse(self.Rmin, self.Rmax, self.Zmin, self.Zmax)
+        nx,ny = self.R.shape
+
+        self._solver = multigrid.createVcycleCUDA(nx, ny,
+                                                  generator,
+                                                  nlevels=nlevels,
+                                                  ncycle=ncycle,
+                                                  niter=niter,
+                                                  direct=direct)
+
     def setSolver(solver):
         """
         Sets the linear solver to use. The given object/function must have a __call__ method
@@ -171,15 +261,19 @@ class Equilibrium:
         """
         Radial magnetic field due to plasma
         Br = -1/R dpsi/dZ
+
+        R and Z can be scalars or arrays of the same shape
         """
-        return -self.psi_func(R,Z,dy=1)[0][0]/R
+        return -self.psi_func(R,Z,dy=1,grid=False)/R
         
     def plasmaBz(self, R, Z):
         """
-        Vertical magnetic field due to plasma 
+        Vertical magnetic field due to plasma
         Bz = (1/R) dpsi/dR
+
+        R and Z can be scalars or arrays of the same shape
         """
-        return self.psi_func(R,Z,dx=1)[0][0]/R
+        return self.psi_func(R,Z,dx=1,grid=False)/R
         
     def Br(self, R, Z):
         """
@@ -195,7 +289,16 @@ class Equilibrium:
     
     def psi(self):
         #return self.plasma_psi + self.tokamak.psi(self.R, self.Z)
-        return self.plasma_psi + self.tokamak.calcPsiFromGreens(self._pgreen)
+
+        # Only recalculate the coil contribution if a current has changed
+        key = self.tokamak.getCurrents()
+        if key != self._psi_coil_key:
+            if self._pgreen_stack is not None:
+                self._psi_coil_cache = self.tokamak.calcPsiFromGreensStacked(self._pgreen_stack)
+            else:
+                self._psi_coil_cache = self.tokamak.calcPsiFromGreens(self._pgreen)
+            self._psi_coil_key = key
+        return self.plasma_psi + self._psi_coil_cache
         
     def psiRZ(self, R, Z):
         """
@@ -250,6 +353,7 @@ class Equilibrium:
         profiles  - An object describing the plasma profiles.
                     At minimum this must have methods:
              .Jtor(R, Z, psi)   -> [nx, ny]
+                 (may optionally accept an out= array to write into)
              .pprime(psinorm)
              .ffprime(psinorm)
              .pressure(psinorm)
@@ -257,42 +361,62 @@ class Equilibrium:
         """
         
         self._profiles = profiles
-        
-        # Calculate toroidal current density
-        Jtor = profiles.Jtor(self.R, self.Z, self.psi())
+
+        # Calculate toroidal current density, re-using a persistent
+        # buffer when the profiles object's Jtor accepts an output
+        # array
+        if "out" in inspect.signature(profiles.Jtor).parameters:
+            Jtor = profiles.Jtor(self.R, self.Z, self.psi(),
+                                 out=self._jtor_buf)
+        else:
+            Jtor = profiles.Jtor(self.R, self.Z, self.psi())
         
         # Set plasma boundary
         # Note that the Equilibrium is passed to the boundary function
         # since the boundary may need to run the G-S solver (von Hagenow's method)
         self._applyBoundary(self, Jtor, self.plasma_psi)
         
-        # Right hand side of G-S equation
-        rhs = -mu0 * self.R * Jtor
+        # Right hand side of G-S equation, written into a
+        # persistent buffer to avoid temporary allocations
+        rhs = self._rhs
+        multiply(self.R, Jtor, out=rhs)
+        rhs *= -mu0
 
         # Copy boundary conditions
-        rhs[0,:] = self.plasma_psi[0,:]
-        rhs[:,0] = self.plasma_psi[:,0]
-        rhs[-1,:] = self.plasma_psi[-1,:]
-        rhs[:,-1] = self.plasma_psi[:,-1]
-        
+        copyto(rhs, self.plasma_psi, where=self._bmask)
+
         # Call elliptic solver
         plasma_psi = self._solver(self.plasma_psi, rhs)
         
         self._updatePlasmaPsi(plasma_psi)
 
-        # Update plasma current
+        # Update plasma current, integrating Jtor using precomputed
+        # Romberg weights (equivalent to romb(romb(Jtor)))
         dR = self.R[1,0] - self.R[0,0]
         dZ = self.Z[0,1] - self.Z[0,0]
-        self._current = romb(romb(Jtor)) * dR*dZ
+        self._current = einsum('i,j,ij->', self._romb_wR, self._romb_wZ, Jtor) * dR*dZ
         
     def _updatePlasmaPsi(self, plasma_psi):
         """
-        Sets the plasma psi data, updates spline interpolation coefficients
+        Sets the plasma psi data, invalidating the spline interpolation.
+        The spline is rebuilt on demand by psi_func, so solves which
+        don't evaluate psi off the grid skip the fit entirely
         """
-        self.plasma_psi = plasma_psi
+        # Store at the working precision. The direct solver and
+        # interpolation always return double precision
+        self.plasma_psi = plasma_psi.astype(self.dtype, copy=False)
+
+        self._psi_func = None
 
-        # Update spline interpolation
-        self.psi_func = interpolate.RectBivariateSpline(self.R[:,0], self.Z[0,:], plasma_psi)
+    @property
+    def psi_func(self):
+        """
+        Spline interpolation of plasma_psi (in double precision),
+        constructed on first use after each update of plasma_psi
+        """
+        if self._psi_func is None:
+            self._psi_func = interpolate.RectBivariateSpline(self._R1d, self._Z1d, self.plasma_psi)
+        return self._psi_func
      
     def plot(self, axis=None, show=True, oxpoints=True):
         """
@@ -307,24 +431,55 @@ class Equilibrium:
         return plotEquilibrium(self, axis=axis, show=show, oxpoints=oxpoints)
     
 
+def _refineGreens(pgreen):
+    """
+    Interpolate a Greens function map (as returned by createPsiGreens)
+    onto a grid with double the resolution, using bilinear interpolation.
+    Much cheaper than re-evaluating the elliptic integrals at every
+    grid point, at the cost of second-order interpolation error
+    """
+    if isinstance(pgreen, dict):
+        # Note: Circuits contain a dictionary of Greens functions
+        return {label: _refineGreens(g) for label, g in pgreen.items()}
+
+    nx, ny = pgreen.shape
+    out = zeros([2*(nx-1) + 1, 2*(ny-1) + 1])
+    out[::2, ::2] = pgreen
+    out[1::2, ::2] = 0.5*(pgreen[:-1,:] + pgreen[1:,:])
+    out[::2, 1::2] = 0.5*(pgreen[:,:-1] + pgreen[:,1:])
+    out[1::2, 1::2] = 0.25*( pgreen[:-1,:-1] + pgreen[1:,:-1]
+                             + pgreen[:-1,1:] + pgreen[1:,1:] )
+    return out
+
+def _coarsenGreens(pgreen):
+    """
+    Restrict a Greens function map onto a grid with half the resolution.
+    Coarse grid points coincide with fine grid points, so this is exact
+    """
+    if isinstance(pgreen, dict):
+        return {label: _coarsenGreens(g) for label, g in pgreen.items()}
+
+    return pgreen[::2, ::2].copy()
+
 def refine(eq):
     """
     Double grid resolution, returning a new equilibrium
-    
+
     """
     # Interpolate the plasma psi
     plasma_psi = multigrid.interpolate(eq.plasma_psi)
     nx, ny = plasma_psi.shape
-    
+
     result = Equilibrium(tokamak=eq.tokamak,
                          Rmin = eq.Rmin,
                          Rmax = eq.Rmax,
                          Zmin = eq.Zmin,
                          Zmax = eq.Zmax,
-                         nx=nx, ny=ny)
+                         nx=nx, ny=ny,
+                         dtype=eq.dtype,
+                         pgreen=_refineGreens(eq._pgreen),
+                         psi=plasma_psi)
 
-    result._updatePlasmaPsi(plasma_psi)
-    
     if hasattr(eq, "_profiles"):
         result._profiles = eq._profiles
 
@@ -339,16 +494,17 @@ def coarsen(eq):
     """
     plasma_psi = multigrid.restrict(eq.plasma_psi)
     nx, ny = plasma_psi.shape
-    
+
     result = Equilibrium(tokamak=eq.tokamak,
                          Rmin = eq.Rmin,
                          Rmax = eq.Rmax,
                          Zmin = eq.Zmin,
                          Zmax = eq.Zmax,
-                         nx=nx, ny=ny)
+                         nx=nx, ny=ny,
+                         dtype=eq.dtype,
+                         pgreen=_coarsenGreens(eq._pgreen),
+                         psi=plasma_psi)
 
-    result._updatePlasmaPsi(plasma_psi)
-    
     if hasattr(eq, "_profiles"):
         result._profiles = eq._profiles
 
@@ -380,8 +536,8 @@ if __name__=="__main__":
     psi = eq.psi()
 
     tck = interpolate.bisplrep(ravel(eq.R), ravel(eq.Z), ravel(psi))
-    spline = interpolate.RectBivariateSpline(eq.R[:,0], eq.Z[0,:], psi)
-    f = interpolate.interp2d(eq.R[:,0], eq.Z[0,:],psi, kind='cubic')
+    spline = interpolate.RectBivariateSpline(eq._R1d, eq._Z1d, psi)
+    f = interpolate.interp2d(eq._R1d, eq._Z1d, psi, kind='cubic')
 
     plt.plot(eq.R[:,10], psi[:,10], 'o')
 
@@ -20,14 +20,14 @@ along with FreeGS.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-from numpy import zeros
+from numpy import zeros, arange, ones, full, repeat, concatenate
 
 # Elliptic integrals of first and second kind (K and E)
 from scipy.special import ellipk, ellipe
 
 from numpy import sqrt, pi, clip
 
-from scipy.sparse import lil_matrix, eye
+from scipy.sparse import lil_matrix, eye, csr_matrix
 
 # Physical constants
 mu0 = 4e-7*pi
@@ -98,46 +98,74 @@ class GSsparse:
     def __call__(self, nx, ny):
         """
         Create a sparse matrix with given resolution
-        
+
+        The matrix is assembled as flat (data, row, col) arrays and
+        converted to CSR in one go, which is much faster than
+        incremental insertion into a linked-list matrix
+
         """
 
         # Calculate grid spacing
         dR = (self.Rmax - self.Rmin)/(nx - 1)
         dZ = (self.Zmax - self.Zmin)/(ny - 1)
-        
+
         # Total number of points
         N = nx * ny
 
-        # Create a linked list sparse matrix
-        A = eye(N, format="lil")
-        
         invdR2 = 1./dR**2
         invdZ2 = 1./dZ**2
-        
-        for x in range(1,nx-1):
-            R = self.Rmin + dR*x  # Major radius of this point
-            for y in range(1,ny-1):
-                # Loop over points in the domain
-                row = x*ny + y
 
-                # y-1 
-                A[row, row-1] = invdZ2
+        # Row indices of the interior points, in row-major order
+        x = arange(1, nx-1)
+        y = arange(1, ny-1)
+        rows = (x[:,None]*ny + y[None,:]).ravel()
+        nin = rows.size  # Number of interior points
 
-                # x-1
-                A[row, row-ny] = (invdR2 + 1./(2.*R*dR))
+        R = self.Rmin + dR*x  # Major radius of each interior point
 
-                # diagonal
-                A[row, row] = - 2.*(invdR2 + invdZ2)
+        # Stencil coefficients, repeated over the y points of each x row.
+        # Duplicate (row, col) entries are summed when converting to CSR,
+        # so the interior diagonal carries (value - 1) on top of the identity
+        data = concatenate([
+            ones(N),                                      # Identity (boundary condition)
+            full(nin, invdZ2),                            # y-1
+            repeat(invdR2 + 1./(2.*R*dR), ny-2),          # x-1
+            full(nin, -2.*(invdR2 + invdZ2) - 1.0),       # diagonal
+            repeat(invdR2 - 1./(2.*R*dR), ny-2),          # x+1
+            full(nin, invdZ2)])                           # y+1
 
-                # x+1
-                A[row, row+ny] = (invdR2 - 1./(2.*R*dR))
+        row = concatenate([arange(N), rows, rows, rows, rows, rows])
+        col = concatenate([arange(N), rows-1, rows-ny, rows, rows+ny, rows+1])
 
-                # y+1
-                A[row, row+1] = invdZ2
-                
         # Convert to Compressed Sparse Row (CSR) format
-        return A.tocsr()
-    
+        return csr_matrix((data, (row, col)), shape=(N, N))
+
+    def stencil(self, nx, ny):
+        """
+        Return the coefficients of the 5-point stencil at a given
+        resolution, for use in stencil-based (matrix free) smoothers.
+
+        Returns (aW, aE, aZ, diag) where for interior points
+
+        A psi = aW[x]*psi[x-1,y] + aE[x]*psi[x+1,y]
+                + aZ*(psi[x,y-1] + psi[x,y+1]) + diag*psi[x,y]
+
+        aW and aE are 1D arrays of length nx; aZ and diag are scalars.
+        Boundary points are identity rows.
+        """
+        dR = (self.Rmax - self.Rmin)/(nx - 1)
+        dZ = (self.Zmax - self.Zmin)/(ny - 1)
+
+        invdR2 = 1./dR**2
+        invdZ2 = 1./dZ**2
+
+        R = self.Rmin + dR*arange(nx)  # Major radius of each point
+
+        aW = invdR2 + 1./(2.*R*dR)
+        aE = invdR2 - 1./(2.*R*dR)
+
+        return aW, aE, invdZ2, -2.*(invdR2 + invdZ2)
+
 def Greens(Rc, Zc, R, Z):
     """
     Calculate poloidal flux at (R,Z) due to a unit current
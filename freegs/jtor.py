@@ -3,8 +3,9 @@
 
  These must have the following methods:
 
-   Jtor(R, Z, psi) 
+   Jtor(R, Z, psi, out=None)
       -> Return a numpy array of toroidal current density [J/m^2]
+         If out is given, the result is written into it and returned
    pprime(psinorm)
       -> return p' at given normalised psi
    ffprime(psinorm)
@@ -39,7 +40,7 @@ from scipy.integrate import romb, quad # Romberg integration
 from . import critical
 from .gradshafranov import mu0
 
-from numpy import clip, zeros, reshape, sqrt, pi
+from numpy import clip, zeros, reshape, sqrt, pi, multiply
 
 
 class Profile(object):
@@ -156,21 +157,23 @@ class ConstrainBetapIp(Profile):
         self.alpha_n = alpha_n
         self.Raxis = Raxis
 
-    def Jtor(self, R, Z, psi):
+    def Jtor(self, R, Z, psi, out=None):
         """ Calculate toroidal plasma current
-        
+
          Jtor = L * (Beta0*R/Raxis + (1-Beta0)*Raxis/R)*jtorshape
-        
+
          where jtorshape is a shape function
          L and Beta0 are parameters which are set by constraints
+
+         If out is given, the result is written into it and returned
         """
-        
+
         # Analyse the equilibrium, finding O- and X-points
         opt, xpt = critical.find_critical(R, Z, psi)
         if not opt:
             raise ValueError("No O-points found!")
         psi_axis = opt[0][2]
-        
+
         if xpt:
             psi_bndry = xpt[0][2]
             mask = critical.core_mask(R, Z, psi, opt, xpt)
@@ -178,24 +181,24 @@ class ConstrainBetapIp(Profile):
             # No X-points
             psi_bndry = psi[0,0]
             mask = None
-        
+
         dR = R[1,0] - R[0,0]
         dZ = Z[0,1] - Z[0,0]
-        
+
         # Calculate normalised psi.
         # 0 = magnetic axis
         # 1 = plasma boundary
         psi_norm = (psi - psi_axis)  / (psi_bndry - psi_axis)
-        
+
         # Current profile shape
         jtorshape = (1. - psi_norm**self.alpha_m)**self.alpha_n
-        
+
         if mask is not None:
             # If there is a masking function (X-points, limiters)
             jtorshape *= mask
-            
+
         # Now apply constraints to define constants
-        
+
         # Need integral of jtorshape to calculate pressure
         # Note factor to convert from normalised psi integral
         def pshape(psinorm):
@@ -239,10 +242,14 @@ class ConstrainBetapIp(Profile):
         Beta0 = LBeta0 / L
 
         print("Constraints: L = %e, Beta0 = %e" % (L, Beta0))
-        
-        # Toroidal current
-        Jtor = L * (Beta0*R/self.Raxis + (1-Beta0)*self.Raxis/R)*jtorshape
-        
+
+        # Toroidal current, written into the output buffer if given
+        if out is None:
+            out = zeros(R.shape)
+        multiply(Beta0*R/self.Raxis + (1-Beta0)*self.Raxis/R, jtorshape, out=out)
+        out *= L
+        Jtor = out
+
         self.L = L
         self.Beta0 = Beta0
         self.psi_bndry = psi_bndry
@@ -257,16 +264,16 @@ class ConstrainBetapIp(Profile):
         """
         shape = (1. - pn**self.alpha_m)**self.alpha_n
         return self.L * self.Beta0/self.Raxis * shape
-        
+
     def ffprime(self, pn):
         """
         f * df/dpsi as a function of normalised psi
         """
         shape = (1. - pn**self.alpha_m)**self.alpha_n
         return mu0 * self.L * (1-self.Beta0)*self.Raxis * shape
-        
+
         return Jtor, pprime, ffprime
-        
+
     def fvac(self):
         return self._fvac
 
@@ -302,13 +309,15 @@ class ConstrainPaxisIp(Profile):
         self.alpha_n = alpha_n
         self.Raxis = Raxis
 
-    def Jtor(self, R, Z, psi):
+    def Jtor(self, R, Z, psi, out=None):
         """ Calculate toroidal plasma current
-        
+
          Jtor = L * (Beta0*R/Raxis + (1-Beta0)*Raxis/R)*jtorshape
-        
+
          where jtorshape is a shape function
          L and Beta0 are parameters which are set by constraints
+
+         If out is given, the result is written into it and returned
         """
         
         # Analyse the equilibrium, finding O- and X-points
@@ -368,10 +377,14 @@ class ConstrainPaxisIp(Profile):
         Beta0 = LBeta0 / L
 
         print("Constraints: L = %e, Beta0 = %e" % (L, Beta0))
-        
-        # Toroidal current
-        Jtor = L * (Beta0*R/self.Raxis + (1-Beta0)*self.Raxis/R)*jtorshape
-        
+
+        # Toroidal current, written into the output buffer if given
+        if out is None:
+            out = zeros(R.shape)
+        multiply(Beta0*R/self.Raxis + (1-Beta0)*self.Raxis/R, jtorshape, out=out)
+        out *= L
+        Jtor = out
+
         self.L = L
         self.Beta0 = Beta0
         self.psi_bndry = psi_bndry
@@ -424,11 +437,13 @@ class ProfilesPprimeFfprime:
         self.f_func = f_func
         self._fvac = fvac
         
-    def Jtor(self, R, Z, psi):
+    def Jtor(self, R, Z, psi, out=None):
         """
         Calculate toroidal plasma current
-        
+
         Jtor = R*p' + ff'/(R*mu0)
+
+        If out is given, the result is written into it and returned
         """
         
         # Analyse the equilibrium, finding O- and X-points
@@ -452,13 +467,17 @@ class ProfilesPprimeFfprime:
         # 0 = magnetic axis
         # 1 = plasma boundary
         psi_norm = clip((psi - psi_axis)  / (psi_bndry - psi_axis), 0.0, 1.0)
-        Jtor = R * self.pprime(psi_norm) + self.ffprime(psi_norm)/(R * mu0)
+
+        if out is None:
+            out = zeros(R.shape)
+        multiply(R, self.pprime(psi_norm), out=out)
+        out += self.ffprime(psi_norm)/(R * mu0)
 
         if mask is not None:
             # If there is a masking function (X-points, limiters)
-            Jtor *= mask
-        
-        return Jtor
+            out *= mask
+
+        return out
 
     def pressure(self, psinorm, out=None):
         """
@@ -24,7 +24,7 @@ along with FreeGS.  If not, see <http://www.gnu.org/licenses/>.
 
 from .gradshafranov import Greens, GreensBr, GreensBz
 
-from numpy import linspace
+from numpy import linspace, array, stack, einsum
 
 class Coil:
     """
@@ -72,6 +72,12 @@ class Coil:
         """
         return self.current * pgreen
 
+    def unitPsiGreens(self, pgreen):
+        """
+        Return the Greens function array giving psi per unit current
+        """
+        return pgreen
+
     def Br(self, R, Z):
         """
         Calculate radial magnetic field Br at (R,Z)
@@ -154,7 +160,17 @@ class Circuit:
             coil.current = self.current * multiplier
             psival += coil.calcPsiFromGreens(pgreen[label])
         return psival
-        
+
+    def unitPsiGreens(self, pgreen):
+        """
+        Return the Greens function array giving psi per unit
+        circuit current, summing the coils with their multipliers
+        """
+        result = 0.0
+        for label, coil, multiplier in self.coils:
+            result += multiplier * coil.unitPsiGreens(pgreen[label])
+        return result
+
     def Br(self, R, Z):
         """
         Calculate radial magnetic field Br at (R,Z)
@@ -256,6 +272,12 @@ class Solenoid:
         """
         return self.current * pgreen
 
+    def unitPsiGreens(self, pgreen):
+        """
+        Return the Greens function array giving psi per unit current
+        """
+        return pgreen
+
     def Br(self, R, Z):
         """
         Calculate radial magnetic field Br at (R,Z)
@@ -359,6 +381,27 @@ class Machine:
             psi_coils += coil.calcPsiFromGreens(pgreen[label])
         return psi_coils
 
+    def stackPsiGreens(self, pgreen):
+        """
+        Stack the per-coil Greens functions from createPsiGreens
+        into a single contiguous (ncoils, nx, ny) array, one slice
+        per entry in the coils list. Returns None if the machine
+        has no coils.
+        """
+        if not self.coils:
+            return None
+        return stack([coil.unitPsiGreens(pgreen[label])
+                      for label, coil in self.coils])
+
+    def calcPsiFromGreensStacked(self, pgreen_arr):
+        """
+        Compute the coil psi as a single contraction of the array
+        from stackPsiGreens with the coil currents, rather than
+        summing per-coil arrays one at a time in Python
+        """
+        currents = array(self.getCurrents(), dtype=pgreen_arr.dtype)
+        return einsum('c,cij->ij', currents, pgreen_arr)
+
     def Br(self, R, Z):
         """
         Radial magnetic field at given points
@@ -404,6 +447,14 @@ class Machine:
                  for label, coil in self.coils if coil.control]
         
 
+    def getCurrents(self):
+        """
+        Returns a tuple of the coil currents, in the same
+        order as the coils list. Cheap to compute, so can be
+        used as a cache key for the Greens function sums
+        """
+        return tuple(coil.current for label, coil in self.coils)
+
     def controlAdjust(self, current_change):
         """
         Add given currents to the controls.
@@ -27,10 +27,75 @@ along with FreeGS.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-from numpy import zeros,max,amin,amax, abs, reshape
+import numpy
+
+from numpy import zeros,max,amin,amax, abs, reshape, subtract
 from scipy.sparse.linalg import factorized
 from scipy.sparse import eye, lil_matrix
 
+# Optional Numba acceleration of the Jacobi smoother.
+# If Numba is not installed, the sparse matrix smoother is used instead
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+if HAVE_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def jacobi_sweep(x, b, work, aW, aE, aZ, diag, niter):
+        """
+        Perform niter Jacobi iterations on the 5-point stencil
+
+        A psi = aW[i]*psi[i-1,j] + aE[i]*psi[i+1,j]
+                + aZ*(psi[i,j-1] + psi[i,j+1]) + diag*psi[i,j]
+
+        with identity rows on the boundary.
+
+        x and work are alternated as source and destination buffers;
+        returns the buffer holding the final result (x if niter is
+        even, work if odd).
+
+        The sweep is tiled in 64x64 blocks so that on grids too large
+        for L2 cache the source and destination tiles stay resident
+        while being traversed. Jacobi reads only the previous sweep's
+        values, so the traversal order doesn't change the result.
+        """
+        nx, ny = x.shape
+        tile = 64
+        ntiles = (nx - 2 + tile - 1) // tile  # Tile rows, for parallel loop
+        xold = x
+        xnew = work
+        for it in range(niter):
+            for t in prange(ntiles):
+                i0 = 1 + t*tile
+                i1 = min(i0 + tile, nx-1)
+                for jj in range(1, ny-1, tile):
+                    j1 = min(jj + tile, ny-1)
+                    for i in range(i0, i1):
+                        for j in range(jj, j1):
+                            xnew[i,j] = ( b[i,j]
+                                          - aZ*(xold[i,j-1] + xold[i,j+1])
+                                          - aW[i]*xold[i-1,j]
+                                          - aE[i]*xold[i+1,j] ) / diag
+            # Boundary rows are identity
+            for i in prange(nx):
+                xnew[i,0] = b[i,0]
+                xnew[i,ny-1] = b[i,ny-1]
+            for j in prange(ny):
+                xnew[0,j] = b[0,j]
+                xnew[nx-1,j] = b[nx-1,j]
+            xold, xnew = xnew, xold
+        return xold
+
+# Optional CuPy/CUDA acceleration. Arrays stay on the device for the
+# whole V-cycle; data is transferred only on entry and exit
+try:
+    import cupy
+    HAVE_CUPY = True
+except ImportError:
+    HAVE_CUPY = False
+
 class MGDirect:
     def __init__(self, A):
         self.solve = factorized(A.tocsc()) # LU decompose
@@ -43,108 +108,410 @@ class MGDirect:
         return reshape(x, b.shape)
         
 class MGJacobi:
-    def __init__(self, A, ncycle=4, niter=10, subsolver=None):
+    def __init__(self, A, ncycle=4, niter=10, subsolver=None, stencil=None):
         """
         Initialise solver
-        
+
         A   - The matrix to solve
         subsolver - An operator at lower resolution
         ncycle - Number of V-cycles
         niter - Number of Jacobi iterations
-        
+        stencil - Optional 5-point stencil coefficients (aW, aE, aZ, diag)
+                  (e.g. from GSsparse.stencil). If given, and Numba is
+                  available, smoothing uses a compiled stencil sweep
+                  rather than sparse matrix-vector products
+
         """
         self.A = A
         self.diag = A.diagonal()
         self.subsolver = subsolver
         self.niter = niter
         self.ncycle = ncycle
-        
+
+        self.stencil = stencil if HAVE_NUMBA else None
+        self._work = None  # Work buffer for the stencil smoother
+
         self.sub_b = None
         self.xupdate = None
-        
+
+    def smooth(self, xi, bi, niter):
+        """
+        Perform niter Jacobi smoothing iterations, modifying xi in place
+
+        xi, bi - 2D arrays of the solution and right-hand side
+        """
+        if self.stencil is not None:
+            aW, aE, aZ, diag = self.stencil
+            if self._work is None or self._work.shape != xi.shape \
+               or self._work.dtype != xi.dtype:
+                self._work = zeros(xi.shape, dtype=xi.dtype)
+            result = jacobi_sweep(xi, bi, self._work, aW, aE, aZ, diag, niter)
+            if result is not xi:
+                # Odd number of sweeps: result is in the work buffer
+                xi[:,:] = result
+            return
+
+        x = reshape(xi, -1)
+        b = reshape(bi, -1)
+        for i in range(niter):
+            x += (b - self.A.dot(x))/self.diag
+
     def __call__(self, xi, bi, ncycle=None, niter=None):
         """
         Solve Ax = b, given initial guess for x
-        
+
         ncycle - Optional number of cycles
-        
+
         """
-        
+
         # Need to reshape x and b into 1D arrays
         x = reshape(xi, -1)
         b = reshape(bi, -1)
 
+        # 2D views of the same data, for the stencil smoother
+        x2d = reshape(x, xi.shape)
+        b2d = reshape(b, bi.shape)
+
         if ncycle is None:
             ncycle = self.ncycle
         if niter is None:
             niter = self.niter
-        
+
         for c in range(ncycle):
             # Jacobi smoothing
-            for i in range(niter):
-                x += (b - self.A.dot(x))/self.diag
+            self.smooth(x2d, b2d, niter)
 
             if self.subsolver:
                 # Calculate the error
                 error = b - self.A.dot(x)
-            
+
                 # Restrict error onto coarser mesh
                 self.sub_b = restrict(reshape(error, xi.shape))
-            
+
                 # smooth this error
                 sub_x = zeros(self.sub_b.shape)
                 sub_x = self.subsolver(sub_x, self.sub_b)
-                
+
                 # Prolong the solution
                 self.xupdate = interpolate(sub_x)
-        
+
                 x += reshape(self.xupdate,-1)
-            
+
             # Jacobi smoothing
-            for i in range(niter):
-                x += (b - self.A.dot(x))/self.diag
+            self.smooth(x2d, b2d, niter)
 
         return x.reshape(xi.shape)
     
     
+class MGVcycle:
+    """
+    Multigrid V-cycle over a flat list of levels.
+
+    Unlike a recursive hierarchy of solvers, each cycle restricts the
+    finest-level defect through every coarser level in a single
+    down-sweep, then solves at the coarsest level and prolongs the
+    correction back up with smoothing at each level. This transfers
+    the defect once per cycle rather than recomputing residuals on
+    the way down.
+    """
+    def __init__(self, levels, coarsest, ncycle=1, niter=10):
+        """
+        levels   - List of MGJacobi smoothers, finest level first,
+                   excluding the coarsest level
+        coarsest - Solver for the coarsest level (e.g. MGDirect)
+        ncycle   - Number of V-cycles per call
+        niter    - Number of smoothing iterations per level
+        """
+        self.levels = levels
+        self.coarsest = coarsest
+        self.ncycle = ncycle
+        self.niter = niter
+
+        # Per-level defect and correction workspaces, allocated on
+        # first use and kept across calls so repeated solves (e.g.
+        # Picard iterations) do not re-allocate each cycle
+        self._defects = None
+        self._errors = None
+
+    def __call__(self, xi, bi, ncycle=None, niter=None):
+        """
+        Solve Ax = b, given initial guess for x
+
+        ncycle - Optional number of cycles
+
+        """
+        x = reshape(xi, -1)
+        b = reshape(bi, -1)
+
+        # 2D views of the same data
+        x2d = reshape(x, xi.shape)
+        b2d = reshape(b, bi.shape)
+
+        if ncycle is None:
+            ncycle = self.ncycle
+        if niter is None:
+            niter = self.niter
+
+        nlev = len(self.levels)
+
+        # Allocate the level workspaces on first use, or if the grid
+        # shape or precision has changed
+        if ( self._defects is None
+             or self._defects[0].shape != xi.shape
+             or self._defects[0].dtype != xi.dtype ):
+            shapes = [xi.shape]
+            for k in range(nlev):
+                nxk, nyk = shapes[-1]
+                shapes.append(( (nxk-1)//2 + 1, (nyk-1)//2 + 1 ))
+            self._defects = [zeros(s, dtype=xi.dtype) for s in shapes]
+            self._errors = [zeros(s, dtype=xi.dtype) for s in shapes]
+
+        defects = self._defects
+        errors = self._errors
+
+        for c in range(ncycle):
+            # Pre-smooth at the finest level
+            self.levels[0].smooth(x2d, b2d, niter)
+
+            # Calculate the defect, and restrict through all levels at
+            # once. Full weighting is needed here: the defect is not
+            # smoothed at intermediate levels, so point sampling
+            # would alias its high frequencies
+            subtract(b, self.levels[0].A.dot(x), out=reshape(defects[0], -1))
+            for k in range(1, nlev + 1):
+                fullWeightRestrict(defects[k-1], out=defects[k])
+
+            # Solve on the coarsest grid
+            errors[-1].fill(0.0)
+            error = self.coarsest(errors[-1], defects[-1])
+
+            # Prolong the correction back up, smoothing at each level
+            for k in range(nlev - 1, 0, -1):
+                bilinearInterpolate(error, out=errors[k])
+                error = errors[k]
+                self.levels[k].smooth(error, defects[k], niter)
+
+            # Apply the correction at the finest level
+            bilinearInterpolate(error, out=errors[0])
+            x += reshape(errors[0], -1)
+
+            # Post-smooth
+            self.levels[0].smooth(x2d, b2d, niter)
+
+        return x.reshape(xi.shape)
+
 def createVcycle(nx, ny, generator, nlevels=4, ncycle=1, niter=10, direct=True):
     """
-    Create a hierarchy of solvers in a multigrid V-cycle
-    
+    Create a multigrid V-cycle solver
+
     nx, ny - The highest resolution
     generator(nx,ny) - Returns a sparse matrix, given resolution
     nlevels - Number of multigrid levels
     direct - Lowest level uses direct solver
-    ncycle - Number of V cycles. This is only passed to the top level MGJacobi object
+    ncycle - Number of V cycles per call
     niter - Number of Jacobi iterations per level
-    
+
+    """
+
+    def make_smoother(nx, ny, ncycle=1):
+        # Stencil coefficients for the compiled smoother, if the
+        # generator can supply them and Numba is available
+        stencil = None
+        if HAVE_NUMBA and hasattr(generator, "stencil"):
+            stencil = generator.stencil(nx, ny)
+        return MGJacobi(generator(nx, ny), niter=niter, ncycle=ncycle,
+                        subsolver=None, stencil=stencil)
+
+    # Build the smoothing levels, finest first, dividing the
+    # mesh until nlevels is reached or it can't be divided further
+    levels = []
+    while len(levels) < nlevels - 1:
+        if (nx-1) % 2 == 1 or (ny-1) % 2 == 1:
+            # Can't divide any further
+            break
+        levels.append(make_smoother(nx, ny))
+        nx = (nx-1) // 2  + 1
+        ny = (ny-1) // 2  + 1
+
+    if not levels:
+        # Single level
+        if direct:
+            return MGDirect(generator(nx, ny))
+        return make_smoother(nx, ny, ncycle=ncycle)
+
+    # Coarsest level
+    if direct:
+        coarsest = MGDirect(generator(nx, ny))
+    else:
+        coarsest = make_smoother(nx, ny)
+
+    return MGVcycle(levels, coarsest, ncycle=ncycle, niter=niter)
+
+
+def _deviceCSR(A):
+    """
+    Copy a SciPy sparse matrix onto the GPU in CSR format
+    """
+    from cupyx.scipy import sparse as cusparse
+    return cusparse.csr_matrix(A.tocsr())
+
+def fullWeightRestrict(orig, out=None, xp=numpy):
+    """
+    Full-weighting restriction onto a coarser mesh, vectorized.
+    out selects an optional output array to re-use;
+    xp selects the array module: numpy (default) or cupy
+    """
+    nx, ny = orig.shape
+
+    nxc = (nx-1) // 2  + 1
+    nyc = (ny-1) // 2  + 1
+
+    if out is None:
+        out = xp.zeros([nxc, nyc])
+    else:
+        # Only the interior is assigned below, so clear the edges
+        out[0,:] = 0.0
+        out[-1,:] = 0.0
+        out[:,0] = 0.0
+        out[:,-1] = 0.0
+    out[1:-1,1:-1] = ( orig[2:-2:2, 2:-2:2]/4.
+                       + ( orig[1:-3:2, 2:-2:2] + orig[3:-1:2, 2:-2:2]
+                           + orig[2:-2:2, 1:-3:2] + orig[2:-2:2, 3:-1:2] )/8.
+                       + ( orig[1:-3:2, 1:-3:2] + orig[1:-3:2, 3:-1:2]
+                           + orig[3:-1:2, 1:-3:2] + orig[3:-1:2, 3:-1:2] )/16. )
+    return out
+
+def bilinearInterpolate(orig, out=None, xp=numpy):
+    """
+    Bilinear interpolation onto a finer mesh, vectorized.
+    out selects an optional output array to re-use;
+    xp selects the array module: numpy (default) or cupy
+    """
+    nx, ny = orig.shape
+
+    nx2 = 2*(nx-1) + 1
+    ny2 = 2*(ny-1) + 1
+
+    if out is None:
+        out = xp.zeros([nx2, ny2])
+    out[::2, ::2] = orig
+    out[1::2, ::2] = 0.5*(orig[:-1,:] + orig[1:,:])
+    out[::2, 1::2] = 0.5*(orig[:,:-1] + orig[:,1:])
+    out[1::2, 1::2] = 0.25*( orig[:-1,:-1] + orig[1:,:-1]
+                             + orig[:-1,1:] + orig[1:,1:] )
+    return out
+
+class MGDirectCUDA:
+    """
+    Direct solve at the coarsest level of a CUDA V-cycle.
+    The LU factorisation is done on the host; the grid at this
+    level is small so the transfer is cheap
+    """
+    def __init__(self, A):
+        self.solve = factorized(A.tocsc()) # LU decompose
+
+    def cycleDevice(self, x, b):
+        b1d = reshape(cupy.asnumpy(b), -1)
+        return cupy.asarray(reshape(self.solve(b1d), b.shape))
+
+    def __call__(self, xi, bi):
+        b1d = reshape(bi, -1)
+        return reshape(self.solve(b1d), bi.shape)
+
+class MGJacobiCUDA:
+    """
+    Jacobi smoothing and V-cycle recursion on the GPU, using
+    CuPy sparse matrix-vector products. Has the same interface
+    as MGJacobi; host arrays are transferred on entry and exit only
+    """
+    def __init__(self, A, ncycle=4, niter=10, subsolver=None):
+        """
+        A   - The (host, SciPy) matrix to solve
+        subsolver - An operator at lower resolution
+        ncycle - Number of V-cycles
+        niter - Number of Jacobi iterations
+        """
+        self.A = _deviceCSR(A)
+        self.diag = cupy.asarray(A.diagonal())
+        self.subsolver = subsolver
+        self.niter = niter
+        self.ncycle = ncycle
+
+    def cycleDevice(self, xd, bd):
+        """
+        Perform the V cycles on device arrays, returning the solution
+        """
+        x = reshape(xd, -1)
+        b = reshape(bd, -1)
+
+        for c in range(self.ncycle):
+            # Jacobi smoothing
+            for i in range(self.niter):
+                x += (b - self.A.dot(x))/self.diag
+
+            if self.subsolver:
+                # Calculate the error
+                error = b - self.A.dot(x)
+
+                # Restrict error onto coarser mesh
+                sub_b = fullWeightRestrict(reshape(error, xd.shape), xp=cupy)
+
+                # smooth this error
+                sub_x = cupy.zeros(sub_b.shape)
+                sub_x = self.subsolver.cycleDevice(sub_x, sub_b)
+
+                # Prolong the solution
+                x += reshape(bilinearInterpolate(sub_x, xp=cupy), -1)
+
+            # Jacobi smoothing
+            for i in range(self.niter):
+                x += (b - self.A.dot(x))/self.diag
+
+        return reshape(x, xd.shape)
+
+    def __call__(self, xi, bi, ncycle=None, niter=None):
+        """
+        Solve Ax = b, given initial guess for x
+        """
+        xd = cupy.asarray(xi)
+        bd = cupy.asarray(bi)
+
+        xd = self.cycleDevice(xd, bd)
+
+        return cupy.asnumpy(xd)
+
+def createVcycleCUDA(nx, ny, generator, nlevels=4, ncycle=1, niter=10, direct=True):
     """
+    Create a hierarchy of solvers in a multigrid V-cycle,
+    running on the GPU through CuPy. Same interface as createVcycle;
+    raises ImportError if CuPy is not available
+
+    """
+    if not HAVE_CUPY:
+        raise ImportError("CuPy is required for the CUDA solver but could not be imported")
 
     if (nx-1) % 2 == 1 or (ny-1) % 2 == 1:
         # Can't divide any further
         nlevels = 1
-    
+
     if nlevels > 1:
         # Create the solver at lower resolution
 
         nxsub = (nx-1) // 2  + 1
         nysub = (ny-1) // 2  + 1
-        
-        subsolver = createVcycle(nxsub, nysub, generator, nlevels-1,
-                                 niter=niter, direct=direct)
-        
-        # Create the sparse matrix
+
+        subsolver = createVcycleCUDA(nxsub, nysub, generator, nlevels-1,
+                                     niter=niter, direct=direct)
+
         A = generator(nx, ny)
-        # Create the solver
-        return MGJacobi(A, niter=niter, subsolver=subsolver, ncycle=ncycle)
+        return MGJacobiCUDA(A, niter=niter, subsolver=subsolver, ncycle=ncycle)
 
     # At lowest level
-    
-    # Create the sparse matrix
+
     A = generator(nx, ny)
     if direct:
-        return MGDirect(A)
-    return MGJacobi(A, niter=niter, ncycle=ncycle, subsolver=None)
+        return MGDirectCUDA(A)
+    return MGJacobiCUDA(A, niter=niter, ncycle=ncycle, subsolver=None)
         
 
         
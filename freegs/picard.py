@@ -19,7 +19,7 @@ You should have received a copy of the GNU Lesser General Public License
 along with FreeGS.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from numpy import amin, amax
+from numpy import ptp, empty_like, copyto, subtract, absolute
 
 def solve(eq, profiles, constrain=None, rtol=1e-3, blend=0.0,
           show=False, axis=None, pause=0.0001):
@@ -45,7 +45,11 @@ def solve(eq, profiles, constrain=None, rtol=1e-3, blend=0.0,
     
     # Get the total psi = plasma + coils
     psi = eq.psi()
-    
+
+    # Buffers re-used every iteration, to avoid repeated allocation
+    psi_last = empty_like(psi)
+    psi_diff = empty_like(psi)
+
     if show:
         import matplotlib.pyplot as plt
         from .plotting import plotEquilibrium
@@ -78,29 +82,38 @@ def solve(eq, profiles, constrain=None, rtol=1e-3, blend=0.0,
                 plt.pause(pause) 
         
         # Copy psi to compare at the end
-        psi_last = psi.copy()
-        
+        copyto(psi_last, psi)
+
         # Solve equilbrium
         eq.solve(profiles)
-        
+
         # Get the new psi, including coils
         psi = eq.psi()
-    
-        # Compare against last solution
-        psi_last -= psi 
-        psi_maxchange = amax(abs(psi_last))
-        psi_relchange = psi_maxchange/(amax(psi) - amin(psi))
-        
+
+        # Compare against last solution. Only interior points are
+        # included: the boundary ring is imposed directly by the
+        # boundary condition rather than solved for, so it is left
+        # out of the convergence norm
+        subtract(psi_last, psi, out=psi_diff)
+        psi_maxchange = absolute(psi_diff, out=psi_diff)[1:-1,1:-1].max()
+        psi_relchange = psi_maxchange/ptp(psi[1:-1,1:-1])
+
         print("Maximum change in psi: %e. Relative: %e" % (psi_maxchange, psi_relchange))
-        
+
         # Check if the relative change in psi is small enough
         if psi_relchange < rtol:
             break
-        
+
         # Adjust the coil currents
         if constrain is not None:
             constrain(eq)
-        
-        psi = (1. - blend)*eq.psi() + blend*psi_last
+            # Refresh psi to include the adjusted coil currents.
+            # The coil contribution is cached on the currents, so
+            # this costs a single array sum
+            psi = eq.psi()
+
+        # Blend with the previous solution
+        psi *= 1. - blend
+        psi += blend * psi_last
         
         